@@ -1,14 +1,27 @@
+import asyncio
+import errno
+import hashlib
+import io
 import json
+import math
 import os
+import re
 import shutil
-import subprocess
+import sys
 import tempfile
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import asdict, dataclass, field
+from fractions import Fraction
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from typing import Any, Dict, List, Set
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
+import orjson
 from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
 
 app = FastAPI(title="Vibe Python Renderer")
@@ -23,49 +36,362 @@ app.add_middleware(
 )
 
 
+_UNSAFE_NAME_CHARS = re.compile(r"[^\w.-]")
+
+
 def _safe_name(name: str) -> str:
-    return "".join(ch if ch.isalnum() or ch in "._-" else "_" for ch in name)
+    return _UNSAFE_NAME_CHARS.sub("_", name)
+
+
+_UPLOAD_CHUNK = 1 << 20
+_COPY_RANGE_CHUNK = 1 << 22
+# Uploaded media is kept content-addressed so re-renders of an unchanged
+# project skip the disk write and just hard-link the cached copy. It lives in
+# the user's cache dir: /tmp is often RAM-backed and shared between users.
+_MEDIA_CACHE_DIR = Path(
+    os.environ.get(
+        "VIBE_MEDIA_CACHE_DIR",
+        Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "vibe-render",
+    )
+)
+_MEDIA_CACHE_MAX_BYTES = int(os.environ.get("VIBE_MEDIA_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, _COPY_RANGE_CHUNK, offset, offset)
+
+
+def _send_range(src_fd: int, dst_fd: int, offset: int) -> int:
+    # sendfile advances the destination's own file position.
+    return os.sendfile(dst_fd, src_fd, offset, _COPY_RANGE_CHUNK)
+
+
+# copy_file_range can reflink on CoW filesystems; sendfile covers kernels or
+# filesystem pairs where it is unavailable (ENOSYS/EXDEV).
+_KERNEL_COPIES = []
+if hasattr(os, "copy_file_range"):
+    _KERNEL_COPIES.append(_copy_range)
+if sys.platform.startswith("linux"):
+    _KERNEL_COPIES.append(_send_range)
+
+
+def _copy_upload_file(src: Any, target: Path) -> None:
+    """Copy a spooled upload to ``target``, kernel-side when it is backed by a real file."""
+    src.seek(0)
+    # Calling fileno() on a SpooledTemporaryFile still held in memory would
+    # force it to disk, so only take the zero-copy route once it has rolled over.
+    if getattr(src, "_rolled", True):
+        for kernel_copy in _KERNEL_COPIES:
+            try:
+                src_fd = src.fileno()
+                dst_fd = os.open(str(target), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    offset = 0
+                    while copied := kernel_copy(src_fd, dst_fd, offset):
+                        offset += copied
+                finally:
+                    os.close(dst_fd)
+                return
+            except (OSError, io.UnsupportedOperation):
+                src.seek(0)
+    with target.open("wb") as fh:
+        shutil.copyfileobj(src, fh, length=_UPLOAD_CHUNK)
+
+
+# Cached files read in place by running renders, with their use counts;
+# pruning leaves these alone until _unpin_media releases them.
+_MEDIA_IN_USE: Counter = Counter()
+_MEDIA_IN_USE_LOCK = threading.Lock()
+
+
+def _unpin_media(paths: Iterable[str]) -> None:
+    with _MEDIA_IN_USE_LOCK:
+        for path in paths:
+            if _MEDIA_IN_USE[path] > 1:
+                _MEDIA_IN_USE[path] -= 1
+            else:
+                _MEDIA_IN_USE.pop(path, None)
+
+
+def _save_upload(upload: Any, target: Path) -> Tuple[str, str]:
+    """Materialise an upload through the media cache.
+
+    Returns the path to read it from and its SHA-256, which also keys its
+    probe results. The path is ``target`` (hard-linked to the cached copy) unless the cache is on
+    another filesystem, in which case the cached copy is used in place and
+    stays pinned against pruning until the caller passes it to _unpin_media.
+    """
+    src = upload.file
+    src.seek(0)
+    if hasattr(hashlib, "file_digest"):  # 3.11+: hashes via readinto, no per-chunk bytes
+        digest = hashlib.file_digest(src, "sha256")
+    else:
+        digest = hashlib.sha256()
+        while chunk := src.read(_UPLOAD_CHUNK):
+            digest.update(chunk)
+    src.seek(0)
+
+    cached = _MEDIA_CACHE_DIR / digest.hexdigest()
+    # Pinned before checking for it, so a concurrent prune either removes it
+    # first (and it is written again below) or skips it.
+    with _MEDIA_IN_USE_LOCK:
+        _MEDIA_IN_USE[str(cached)] += 1
+    in_place = False
+    try:
+        if cached.exists():
+            os.utime(cached)
+        else:
+            _MEDIA_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp = cached.with_name(f"{cached.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            _copy_upload_file(src, tmp)
+            os.replace(tmp, cached)
+        try:
+            os.link(cached, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            in_place = True
+            return str(cached), cached.name
+    except OSError as e:
+        print(f"[WARN] media cache unavailable ({e}); writing upload directly")
+        _copy_upload_file(src, target)
+    finally:
+        if not in_place:
+            _unpin_media([str(cached)])
+    return str(target), cached.name
+
+
+def _prune_media_cache() -> None:
+    """Evict least recently used cached media beyond the size budget."""
+    try:
+        entries = [(p.stat(), p) for p in _MEDIA_CACHE_DIR.iterdir()
+                   if p.suffix != ".tmp" and p.name != _PROBE_CACHE_PATH.name]
+    except OSError:
+        return
+    total = sum(st.st_size for st, _ in entries)
+    for st, path in sorted(entries, key=lambda e: e[0].st_mtime):
+        if total <= _MEDIA_CACHE_MAX_BYTES:
+            break
+        with _MEDIA_IN_USE_LOCK:
+            if str(path) in _MEDIA_IN_USE:
+                continue
+            try:
+                path.unlink()
+                total -= st.st_size
+            except OSError:
+                pass
+
+
+# Bound concurrent ffprobe spawns so huge projects don't fork-storm the host.
+_PROBE_SEM = asyncio.Semaphore(os.cpu_count() or 4)
+# Probe results persist across renders, keyed by the upload's SHA-256. The
+# file sits in the (private) media cache dir; pruning leaves it alone.
+_PROBE_CACHE_PATH = _MEDIA_CACHE_DIR / "probe-cache.json"
+# Entries kept on disk, oldest (least recently hit) dropped first.
+_PROBE_CACHE_SIZE = 4096
+# In-process LRU in front of the on-disk cache, so repeat renders of the same
+# assets skip both ffprobe and re-reading the JSON file (which is only loaded
+# when some file misses here).
+_PROBE_MEMO: "OrderedDict[str, MediaInfo]" = OrderedDict()
+_PROBE_MEMO_SIZE = 512
+_PROBES_IN_FLIGHT: Dict[str, "asyncio.Future[Optional[MediaInfo]]"] = {}
+
+
+def _parse_rate(value: Any) -> Optional[Fraction]:
+    try:
+        return Fraction(str(value))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+@dataclass
+class MediaInfo:
+    """Stream metadata for one media file, gathered by a single ffprobe call."""
+
+    stream_types: Set[str] = field(default_factory=set)
+    vcodec: Optional[str] = None
+    width: int = 0
+    height: int = 0
+    fps: Optional[Fraction] = None
+    avg_fps: Optional[Fraction] = None
+    pix_fmt: Optional[str] = None
+    sar: Optional[str] = None
+    acodec: Optional[str] = None
+    sample_rate: int = 0
+    channel_layout: str = ""
+    video_streams: int = 0
+    audio_streams: int = 0
+    # Container start time that ffmpeg subtracts from input timestamps; None
+    # for cache entries probed before it was recorded.
+    start_time: Optional[float] = None
+
+    @classmethod
+    def from_streams(cls, streams: List[Dict[str, Any]]) -> "MediaInfo":
+        info = cls()
+        for s in streams:
+            codec_type = s.get("codec_type")
+            if not isinstance(codec_type, str):
+                continue
+            info.stream_types.add(codec_type)
+            if codec_type == "video":
+                info.video_streams += 1
+                if info.video_streams == 1:
+                    info.vcodec = s.get("codec_name")
+                    info.width = int(s.get("width") or 0)
+                    info.height = int(s.get("height") or 0)
+                    info.pix_fmt = s.get("pix_fmt")
+                    info.sar = s.get("sample_aspect_ratio")
+                    info.fps = _parse_rate(s.get("r_frame_rate"))
+                    info.avg_fps = _parse_rate(s.get("avg_frame_rate"))
+            elif codec_type == "audio":
+                info.audio_streams += 1
+                if info.audio_streams == 1:
+                    info.acodec = s.get("codec_name")
+                    info.sample_rate = int(s.get("sample_rate") or 0)
+                    info.channel_layout = str(s.get("channel_layout") or "")
+        return info
+
+    def to_json(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["stream_types"] = sorted(self.stream_types)
+        for key in ("fps", "avg_fps"):
+            data[key] = str(data[key]) if data[key] is not None else None
+        return data
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "MediaInfo":
+        data = dict(data)
+        data["stream_types"] = set(data.get("stream_types", []))
+        for key in ("fps", "avg_fps"):
+            data[key] = Fraction(data[key]) if data.get(key) else None
+        return cls(**data)
+
+    def is_constant_rate(self, framerate: int) -> bool:
+        """Whether the video already runs at exactly ``framerate`` fps, without
+        variable frame timing (average rate equal to the nominal one)."""
+        return self.fps == framerate and self.avg_fps == self.fps
+
+
+def _load_probe_cache() -> Dict[str, Any]:
+    try:
+        data = json.loads(_PROBE_CACHE_PATH.read_text(encoding="utf-8"))
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def _save_probe_cache(cache: Dict[str, Any]) -> None:
+    keep = list(cache.items())[-_PROBE_CACHE_SIZE:]
+    try:
+        _MEDIA_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp = _PROBE_CACHE_PATH.with_name(
+            f"{_PROBE_CACHE_PATH.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        tmp.write_text(json.dumps(dict(keep)), encoding="utf-8")
+        os.replace(tmp, _PROBE_CACHE_PATH)
+    except Exception as e:
+        print(f"[WARN] could not persist probe cache: {e}")
+
 
+def _remember_probe(key: str, info: MediaInfo) -> None:
+    _PROBE_MEMO[key] = info
+    _PROBE_MEMO.move_to_end(key)
+    while len(_PROBE_MEMO) > _PROBE_MEMO_SIZE:
+        _PROBE_MEMO.popitem(last=False)
 
-def _probe_stream_types(path: str) -> Set[str]:
-    """Return stream codec types (e.g. {'video', 'audio'}) for a media file."""
+
+async def _run_ffprobe(path: str) -> Optional[MediaInfo]:
     try:
-        proc = subprocess.run(
-            [
+        async with _PROBE_SEM:
+            proc = await asyncio.create_subprocess_exec(
                 "ffprobe",
                 "-v",
                 "error",
                 "-show_entries",
-                "stream=codec_type",
+                "stream=codec_type,codec_name,width,height,pix_fmt,sample_aspect_ratio,r_frame_rate,"
+                "avg_frame_rate,sample_rate,channel_layout:format=start_time",
                 "-of",
                 "json",
                 path,
-            ],
-            capture_output=True,
-            text=True,
-            check=False,
-        )
-        if proc.returncode != 0 or not proc.stdout:
-            return set()
-        data = json.loads(proc.stdout)
-        streams = data.get("streams", [])
-        return {
-            s.get("codec_type")
-            for s in streams
-            if isinstance(s, dict) and isinstance(s.get("codec_type"), str)
-        }
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, _ = await proc.communicate()
+        if proc.returncode != 0 or not stdout:
+            return None
+        data = json.loads(stdout)
+        info = MediaInfo.from_streams([s for s in data.get("streams", []) if isinstance(s, dict)])
+        info.start_time = float((data.get("format") or {}).get("start_time") or 0.0)
+        return info
     except Exception:
-        return set()
-
-
-def _clip_duration(clip: Dict[str, Any], media: Dict[str, Any]) -> float:
+        return None
+
+
+async def _probe_media_info(path: str, key: str, cache: Dict[str, Any]) -> MediaInfo:
+    """Probe a media file once for all stream metadata, consulting the memo and
+    ``cache`` for its content digest ``key`` first.
+
+    New results are added to ``cache``; the caller persists it.
+    """
+    if key in _PROBE_MEMO:
+        _PROBE_MEMO.move_to_end(key)
+        return _PROBE_MEMO[key]
+    if key in cache:
+        try:
+            info = MediaInfo.from_json(cache[key])
+        except Exception:
+            pass
+        else:
+            # Keep recently used entries at the end, clear of the size cut.
+            cache[key] = cache.pop(key)
+            _remember_probe(key, info)
+            return info
+
+    # Identical files (the same asset under two ids, or the same project
+    # rendered twice at once) share one ffprobe run.
+    pending = _PROBES_IN_FLIGHT.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(_run_ffprobe(path))
+        _PROBES_IN_FLIGHT[key] = pending
+        pending.add_done_callback(lambda _: _PROBES_IN_FLIGHT.pop(key, None))
+    info = await asyncio.shield(pending)
+    if info is None:
+        return MediaInfo()
+
+    cache[key] = info.to_json()
+    _remember_probe(key, info)
+    return info
+
+
+def _timeline_item(clip: Dict[str, Any], media: Dict[str, Any], track_index: int) -> Dict[str, Any]:
+    """Timeline entry for a clip, with its timing parsed once up front."""
+    trim_start = float(clip["trimStart"])
+    trim_end = float(clip["trimEnd"])
     speed = max(0.01, float(clip.get("speed", 1.0)))
-    source_duration = max(0.0, float(media["duration"]) - float(clip["trimStart"]) - float(clip["trimEnd"]))
-    return source_duration / speed
-
-
-def _clip_source_duration(clip: Dict[str, Any], media: Dict[str, Any]) -> float:
-    return max(0.0, float(media["duration"]) - float(clip["trimStart"]) - float(clip["trimEnd"]))
+    source_duration = max(0.0, float(media["duration"]) - trim_start - trim_end)
+    return {
+        "clip": clip,
+        "media": media,
+        "trackIndex": track_index,
+        "start": float(clip["startTime"]),
+        "trimStart": trim_start,
+        "trimEnd": trim_end,
+        "speed": speed,
+        "reverse": bool(clip.get("reverse", False)),
+        "sourceDuration": source_duration,
+        "duration": source_duration / speed,
+    }
+
+
+def _segment_key(item: Dict[str, Any], src_idx: int) -> tuple:
+    """Key identifying clips whose filtered output would be identical."""
+    return (
+        src_idx,
+        _fmt(item["trimStart"]),
+        _fmt(item["sourceDuration"]),
+        _fmt(item["speed"]),
+        item["reverse"],
+    )
 
 
 def _atempo_chain(speed: float) -> List[str]:
@@ -84,6 +410,8 @@ def _atempo_chain(speed: float) -> List[str]:
     return filters
 
 
+# Timelines repeat the same values (speeds, trims, frame durations) a lot.
+@lru_cache(maxsize=4096)
 def _fmt(v: float) -> str:
     return f"{v:.6f}"
 
@@ -92,18 +420,1198 @@ def _clamp(v: float, lo: float, hi: float) -> float:
     return max(lo, min(hi, v))
 
 
-def _escape_drawtext_text(value: str) -> str:
+# Same escaping ffmpeg uses for ASS events: a word joiner after a backslash
+# stops it starting an override tag, braces are escaped.
+_ASS_TEXT_ESCAPES = str.maketrans({"\\": "\\\u2060", "{": "\\{", "}": "\\}", "\n": "\\N"})
+_FILTER_VALUE_ESCAPES = str.maketrans({"\\": "\\\\", ":": "\\:", "'": "\\'"})
+
+
+def _escape_ass_text(value: str) -> str:
+    return value.translate(_ASS_TEXT_ESCAPES)
+
+
+def _escape_filter_value(value: str) -> str:
+    return value.translate(_FILTER_VALUE_ESCAPES)
+
+
+def _input_args(
+    items: Iterable[Dict[str, Any]], media_paths: Dict[str, str], hwaccel: str
+) -> Tuple[List[str], Dict[str, int], Dict[int, float]]:
+    """Return ``-i`` args for the media used by ``items`` (deduped by path, in
+    first-use order), each media id's input index, and the seek offset of
+    inputs opened with ``-ss``.
+
+    When every clip on an input cuts the same range, the input is opened with
+    ``-ss``/``-t`` so the demuxer seeks to it rather than the graph decoding
+    and discarding everything before the trim point.
+    """
+    path_to_idx: Dict[str, int] = {}
+    input_index: Dict[str, int] = {}
+    cuts: Dict[str, Set[Tuple[str, str]]] = {}
+    for item in items:
+        media_id = item["media"]["id"]
+        media_path = media_paths[media_id]
+        input_index[media_id] = path_to_idx.setdefault(media_path, len(path_to_idx))
+        cuts.setdefault(media_path, set()).add((
+            _fmt(item["trimStart"]),
+            _fmt(item["sourceDuration"]),
+        ))
+    args: List[str] = []
+    seeks: Dict[int, float] = {}
+    for media_path, idx in path_to_idx.items():
+        args.extend(["-hwaccel", hwaccel])
+        if len(cuts[media_path]) == 1:
+            start, duration = next(iter(cuts[media_path]))
+            args.extend(["-ss", start, "-t", duration])
+            seeks[idx] = float(start)
+        args.extend(["-i", media_path])
+    return args, input_index, seeks
+
+
+@lru_cache(maxsize=256)
+def _black_frames(width: int, height: int, framerate: int, duration: float) -> str:
+    """Source chain for ``duration`` seconds of black video.
+
+    One black frame is drawn and ``loop`` re-emits it by reference, instead of
+    ``color`` filling a fresh frame for every output frame.
+    """
+    frames = max(1, round(duration * framerate))
     return (
-        value.replace("\\", "\\\\")
-        .replace(":", "\\:")
-        .replace("'", "\\'")
-        .replace("\n", "\\n")
-        .replace("%", "\\%")
+        f"color=c=black:s={width}x{height}:r={framerate}:d={_fmt(1.0 / framerate)}:sar=1,"
+        f"format=yuv420p,loop=loop={frames - 1}:size=1,setpts=N/({framerate}*TB)"
+    )
+
+
+def _fit_filters(info: MediaInfo, width: int, height: int) -> List[str]:
+    """Scale (and pad only if the aspect ratio differs) a source into width x height."""
+    if not info.width or not info.height:
+        return [
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease",
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+        ]
+    if info.width * height == info.height * width:
+        fit_w, fit_h = width, height
+    else:
+        fit_w = min(width, info.width * height // info.height) // 2 * 2
+        fit_h = min(height, info.height * width // info.width) // 2 * 2
+    # fast_bilinear is much cheaper than bicubic and indistinguishable when shrinking.
+    flags = ":flags=fast_bilinear" if fit_w <= info.width and fit_h <= info.height else ""
+    if (fit_w, fit_h) == (width, height):
+        return [f"scale={width}:{height}{flags}"]
+    return [
+        f"scale={fit_w}:{fit_h}{flags}",
+        f"pad={width}:{height}:{(width - fit_w) // 2}:{(height - fit_h) // 2}",
+    ]
+
+
+def _conform_filters(info: MediaInfo, width: int, height: int) -> List[str]:
+    """Scale/pad, pixel format and SAR fixes bringing a source to the output format."""
+    chain: List[str] = []
+    scaled = (info.width, info.height) != (width, height)
+    if scaled:
+        chain.extend(_fit_filters(info, width, height))
+    if info.pix_fmt != "yuv420p":
+        chain.append("format=yuv420p")
+    if scaled or info.sar != "1:1":
+        chain.append("setsar=1")
+    return chain
+
+
+def _shared_fit_filters(
+    all_video: List[Dict[str, Any]],
+    input_index: Dict[str, int],
+    seeks: Dict[int, float],
+    info_by_media: Dict[str, MediaInfo],
+    width: int,
+    height: int,
+    framerate: int,
+) -> Tuple[List[str], Dict[int, List[str]]]:
+    """Conform once per source whose cuts overlap, then split per cut.
+
+    A source cut into several overlapping ranges is trimmed to the span they
+    cover, scaled once and split, rather than scaled again for every cut.
+    Only done when the span is shorter than the cuts combined and the source
+    isn't above the output rate (the per-cut fps would otherwise drop frames
+    after they were scaled). Returns the filters and, per input index, the
+    split labels for the distinct cuts to take their frames from.
+    """
+    ranges: Dict[int, Dict[tuple, Tuple[float, float]]] = {}
+    info_by_src: Dict[int, MediaInfo] = {}
+    for item in all_video:
+        src_idx = input_index[item["media"]["id"]]
+        trim_start = item["trimStart"] - seeks.get(src_idx, 0.0)
+        src_dur = item["sourceDuration"]
+        ranges.setdefault(src_idx, {})[_segment_key(item, src_idx)] = (trim_start, trim_start + src_dur)
+        info_by_src[src_idx] = info_by_media.get(item["media"]["id"], MediaInfo())
+
+    filter_parts: List[str] = []
+    shared: Dict[int, List[str]] = {}
+    for src_idx, cuts in ranges.items():
+        info = info_by_src[src_idx]
+        conform = _conform_filters(info, width, height)
+        if len(cuts) < 2 or not conform or info.fps is None or info.fps > framerate:
+            continue
+        span_start = min(start for start, _ in cuts.values())
+        span_end = max(end for _, end in cuts.values())
+        if span_end - span_start >= sum(end - start for start, end in cuts.values()):
+            continue
+        labels = [f"[vs{src_idx}_{k}]" for k in range(len(cuts))]
+        # trim keeps source timestamps, so each cut trims the split copy as usual.
+        filter_parts.append(
+            f"[{src_idx}:v]trim=start={_fmt(span_start)}:end={_fmt(span_end)},"
+            f"{','.join(conform)},split={len(cuts)}{''.join(labels)}"
+        )
+        shared[src_idx] = labels
+    return filter_parts, shared
+
+
+def _video_timeline_filters(
+    all_video: List[Dict[str, Any]],
+    input_index: Dict[str, int],
+    seeks: Dict[int, float],
+    info_by_media: Dict[str, MediaInfo],
+    width: int,
+    height: int,
+    framerate: int,
+    start_t: float,
+    end_t: float,
+) -> List[str]:
+    """Filter chains concatenating the clips (and black gaps) spanning
+    ``start_t``..``end_t`` of the timeline into ``[vout]``."""
+    video_segments: List[str] = []
+    seg_idx = 0
+    frame_dur = 1.0 / framerate
+
+    # Identical clips (same source range and effects) are filtered once and
+    # fanned out with split instead of re-decoding and re-scaling.
+    key_counts = Counter(_segment_key(item, input_index[item["media"]["id"]]) for item in all_video)
+    dedup: Dict[tuple, List[str]] = {}
+    filter_parts, shared = _shared_fit_filters(
+        all_video, input_index, seeks, info_by_media, width, height, framerate
+    )
+
+    current_t = start_t
+    for item in all_video:
+        clip = item["clip"]
+        media = item["media"]
+        clip_start = item["start"]
+        clip_dur = item["duration"]
+        src_dur = item["sourceDuration"]
+        trim_start = item["trimStart"]
+        speed = item["speed"]
+        reverse = item["reverse"]
+        src_idx = input_index[media["id"]]
+
+        gap = clip_start - current_t
+        if gap > frame_dur:
+            lbl = f"v{seg_idx}"
+            filter_parts.append(
+                f"{_black_frames(width, height, framerate, gap)}[{lbl}]"
+            )
+            video_segments.append(f"[{lbl}]")
+            seg_idx += 1
+
+        key = _segment_key(item, src_idx)
+        if dedup.get(key):
+            video_segments.append(dedup[key].pop(0))
+        else:
+            copies = key_counts[key]
+            labels = [f"[v{seg_idx + i}]" for i in range(copies)]
+            seg_idx += copies
+            info = info_by_media.get(media["id"], MediaInfo())
+            # Inputs seeked with -ss/-t already start and stop at the cut.
+            chain = []
+            if src_idx in shared:
+                # Split copies keep timestamps relative to where the input was opened.
+                chain.append(f"trim=start={_fmt(trim_start - seeks.get(src_idx, 0.0))}:duration={_fmt(src_dur)}")
+            elif src_idx not in seeks:
+                chain.append(f"trim=start={_fmt(trim_start)}:duration={_fmt(src_dur)}")
+            if reverse:
+                chain.append("reverse")
+            chain.append(f"setpts=(PTS-STARTPTS)/{_fmt(speed)}")
+            # Skip per-pixel work the source doesn't need.
+            # A variable-rate source can report the right nominal rate, so
+            # only trust it when the average agrees.
+            if not info.is_constant_rate(framerate) or speed != 1.0:
+                chain.append(f"fps={framerate}")
+            if src_idx in shared:
+                source = shared[src_idx].pop(0)
+            else:
+                source = f"[{src_idx}:v]"
+                chain.extend(_conform_filters(info, width, height))
+            if copies > 1:
+                chain.append(f"split={copies}")
+            filter_parts.append(f"{source}{','.join(chain)}{''.join(labels)}")
+            video_segments.append(labels[0])
+            dedup[key] = labels[1:]
+        current_t = clip_start + clip_dur
+
+        print(f"[V-SEG] clip {clip['id'][:8]} src={src_idx} "
+              f"trim={_fmt(trim_start)}+{_fmt(clip_dur)} @timeline={_fmt(clip_start)}")
+
+    trail = end_t - current_t
+    if trail > frame_dur:
+        lbl = f"v{seg_idx}"
+        filter_parts.append(
+            f"{_black_frames(width, height, framerate, trail)}[{lbl}]"
+        )
+        video_segments.append(f"[{lbl}]")
+        seg_idx += 1
+
+    filter_parts.append(
+        f"{''.join(video_segments)}concat=n={len(video_segments)}:v=1:a=0[vout]"
+    )
+    return filter_parts
+
+
+# CSS colour names (a superset of ffmpeg's colour table, which drawtext took).
+_COLOR_TABLE = """
+aliceblue f0f8ff antiquewhite faebd7 aqua 00ffff aquamarine 7fffd4 azure f0ffff
+beige f5f5dc bisque ffe4c4 black 000000 blanchedalmond ffebcd blue 0000ff
+blueviolet 8a2be2 brown a52a2a burlywood deb887 cadetblue 5f9ea0 chartreuse 7fff00
+chocolate d2691e coral ff7f50 cornflowerblue 6495ed cornsilk fff8dc crimson dc143c
+cyan 00ffff darkblue 00008b darkcyan 008b8b darkgoldenrod b8860b darkgray a9a9a9
+darkgreen 006400 darkgrey a9a9a9 darkkhaki bdb76b darkmagenta 8b008b
+darkolivegreen 556b2f darkorange ff8c00 darkorchid 9932cc darkred 8b0000
+darksalmon e9967a darkseagreen 8fbc8f darkslateblue 483d8b darkslategray 2f4f4f
+darkslategrey 2f4f4f darkturquoise 00ced1 darkviolet 9400d3 deeppink ff1493
+deepskyblue 00bfff dimgray 696969 dimgrey 696969 dodgerblue 1e90ff firebrick b22222
+floralwhite fffaf0 forestgreen 228b22 fuchsia ff00ff gainsboro dcdcdc
+ghostwhite f8f8ff gold ffd700 goldenrod daa520 gray 808080 green 008000
+greenyellow adff2f grey 808080 honeydew f0fff0 hotpink ff69b4 indianred cd5c5c
+indigo 4b0082 ivory fffff0 khaki f0e68c lavender e6e6fa lavenderblush fff0f5
+lawngreen 7cfc00 lemonchiffon fffacd lightblue add8e6 lightcoral f08080
+lightcyan e0ffff lightgoldenrodyellow fafad2 lightgray d3d3d3 lightgreen 90ee90
+lightgrey d3d3d3 lightpink ffb6c1 lightsalmon ffa07a lightseagreen 20b2aa
+lightskyblue 87cefa lightslategray 778899 lightslategrey 778899
+lightsteelblue b0c4de lightyellow ffffe0 lime 00ff00 limegreen 32cd32 linen faf0e6
+magenta ff00ff maroon 800000 mediumaquamarine 66cdaa mediumblue 0000cd
+mediumorchid ba55d3 mediumpurple 9370db mediumseagreen 3cb371
+mediumslateblue 7b68ee mediumspringgreen 00fa9a mediumturquoise 48d1cc
+mediumvioletred c71585 midnightblue 191970 mintcream f5fffa mistyrose ffe4e1
+moccasin ffe4b5 navajowhite ffdead navy 000080 oldlace fdf5e6 olive 808000
+olivedrab 6b8e23 orange ffa500 orangered ff4500 orchid da70d6
+palegoldenrod eee8aa palegreen 98fb98 paleturquoise afeeee palevioletred db7093
+papayawhip ffefd5 peachpuff ffdab9 peru cd853f pink ffc0cb plum dda0dd
+powderblue b0e0e6 purple 800080 rebeccapurple 663399 red ff0000
+rosybrown bc8f8f royalblue 4169e1 saddlebrown 8b4513 salmon fa8072
+sandybrown f4a460 seagreen 2e8b57 seashell fff5ee sienna a0522d silver c0c0c0
+skyblue 87ceeb slateblue 6a5acd slategray 708090 slategrey 708090 snow fffafa
+springgreen 00ff7f steelblue 4682b4 tan d2b48c teal 008080 thistle d8bfd8
+tomato ff6347 turquoise 40e0d0 violet ee82ee wheat f5deb3 white ffffff
+whitesmoke f5f5f5 yellow ffff00 yellowgreen 9acd32
+"""
+_NAMED_COLORS = dict(zip(_COLOR_TABLE.split()[::2], _COLOR_TABLE.split()[1::2]))
+_COLOR_FUNC = re.compile(r"rgba?\(([^)]*)\)")
+_HEX_DIGITS = re.compile(r"[0-9a-f]+")
+_ASS_FONT_UNSAFE = re.compile(r"[\\{}]")
+
+
+def _parse_color(value: str) -> Optional[Tuple[int, int, int, float]]:
+    """Parse ``#rgb``/``#rrggbb[aa]``/``0xrrggbb``, ``rgb[a](...)`` or a colour
+    name (optionally ``name@alpha``) into RGBA."""
+    value = value.strip().lower()
+    alpha = 1.0
+    if "@" in value:
+        value, _, alpha_str = value.partition("@")
+        try:
+            alpha = _clamp(float(alpha_str), 0.0, 1.0)
+        except ValueError:
+            return None
+    if value == "transparent":
+        return (0, 0, 0, 0.0)
+    if value in _NAMED_COLORS:
+        value = "#" + _NAMED_COLORS[value]
+    m = _COLOR_FUNC.fullmatch(value)
+    if m:
+        fields = [f.strip() for f in m.group(1).split(",")]
+        try:
+            r, g, b = (int(_clamp(float(f), 0, 255)) for f in fields[:3])
+            if len(fields) > 3:
+                alpha = _clamp(float(fields[3]), 0.0, 1.0)
+        except ValueError:
+            return None
+        return (r, g, b, alpha)
+    hex_digits = value[1:] if value.startswith("#") else value[2:] if value.startswith("0x") else ""
+    if len(hex_digits) == 3:
+        hex_digits = "".join(ch * 2 for ch in hex_digits)
+    if len(hex_digits) in (6, 8) and _HEX_DIGITS.fullmatch(hex_digits):
+        if len(hex_digits) == 8:
+            alpha = int(hex_digits[6:], 16) / 255
+        return (int(hex_digits[0:2], 16), int(hex_digits[2:4], 16), int(hex_digits[4:6], 16), alpha)
+    return None
+
+
+def _ass_color_tags(value: Any, color_tag: str, alpha_tag: str) -> str:
+    """ASS override tags (e.g. ``\\c``/``\\1a``) for a CSS/ffmpeg colour string."""
+    rgba = _parse_color(value) if isinstance(value, str) else None
+    if rgba is None:
+        return ""
+    r, g, b, a = rgba
+    return f"\\{color_tag}&H{b:02X}{g:02X}{r:02X}&\\{alpha_tag}&H{round((1 - a) * 255):02X}&"
+
+
+def _ass_time(t: float) -> str:
+    cs = max(0, round(t * 100))
+    return f"{cs // 360000}:{cs // 6000 % 60:02d}:{cs // 100 % 60:02d}.{cs % 100:02d}"
+
+
+def _text_overlay_filters(
+    text_overlays: List[Dict[str, Any]],
+    source_label: str,
+    start_t: float,
+    end_t: float,
+    width: int,
+    height: int,
+    temp_dir: str,
+    name: str,
+) -> Tuple[List[str], str]:
+    """Burn in the overlays visible in ``start_t``..``end_t`` (times relative
+    to ``start_t``) with one ``subtitles`` filter over a generated ASS file.
+    Returns the filters and the output label."""
+    events: List[str] = []
+    for item in text_overlays:
+        if item["end"] <= start_t or item["start"] >= end_t:
+            continue
+        overlay = item["overlay"]
+        content = _escape_ass_text(str(overlay.get("content", "")))
+        if content == "":
+            continue
+
+        font_family = _ASS_FONT_UNSAFE.sub("", str(overlay.get("fontFamily", "Arial")))
+        x_norm = _clamp(float(overlay.get("x", 0.5)), 0.0, 1.0)
+        y_norm = _clamp(float(overlay.get("y", 0.85)), 0.0, 1.0)
+        font_size = max(8, int(float(overlay.get("fontSize", 48))))
+        align = str(overlay.get("align", "center")).lower()
+        # Numpad alignment, vertically centred on the anchor point.
+        an = {"left": 4, "right": 6}.get(align, 5)
+
+        tags = (
+            f"\\an{an}\\pos({round(width * x_norm)},{round(height * y_norm)})"
+            f"\\fn{font_family}\\fs{font_size}"
+            + _ass_color_tags(overlay.get("color", "#ffffff"), "c", "1a")
+        )
+        style = "Default"
+        bg_tags = _ass_color_tags(overlay.get("backgroundColor"), "3c", "3a")
+        if bg_tags:
+            # The opaque box of BorderStyle 3 is painted in the outline colour;
+            # an unparseable background gets no box rather than a black one.
+            style = "Box"
+            tags += bg_tags
+
+        start = _ass_time(max(0.0, float(item["start"]) - start_t))
+        end = _ass_time(float(item["end"]) - start_t)
+        events.append(f"Dialogue: 0,{start},{end},{style},,0,0,0,,{{{tags}}}{content}")
+
+    if not events:
+        return [], source_label
+
+    style_fields = "&H00FFFFFF,&H00FFFFFF,&H00000000,&H00000000,0,0,0,0,100,100,0,0"
+    ass_path = Path(temp_dir) / f"{name}.ass"
+    ass_path.write_text(
+        "[Script Info]\n"
+        "ScriptType: v4.00+\n"
+        f"PlayResX: {width}\n"
+        f"PlayResY: {height}\n"
+        "WrapStyle: 2\n"
+        "ScaledBorderAndShadow: yes\n"
+        "\n"
+        "[V4+ Styles]\n"
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, "
+        "BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, "
+        "BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n"
+        f"Style: Default,Arial,48,{style_fields},1,0,0,5,0,0,0,1\n"
+        f"Style: Box,Arial,48,{style_fields},3,8,0,5,0,0,0,1\n"
+        "\n"
+        "[Events]\n"
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+        + "\n".join(events) + "\n",
+        encoding="utf-8",
+    )
+    out_label = "vtxt"
+    return [
+        f"[{source_label}]subtitles=filename='{_escape_filter_value(str(ass_path))}'[{out_label}]"
+    ], out_label
+
+
+def _audio_timeline_filters(
+    all_audio: List[Dict[str, Any]],
+    input_index: Dict[str, int],
+    seeks: Dict[int, float],
+    info_by_media: Dict[str, MediaInfo],
+    end_t: float,
+) -> List[str]:
+    """Filter chains concatenating the audio clips (and silent gaps) into ``[aout]``."""
+    filter_parts: List[str] = []
+    audio_segments: List[str] = []
+    seg_idx = 0
+
+    key_counts = Counter(_segment_key(item, input_index[item["media"]["id"]]) for item in all_audio)
+    dedup: Dict[tuple, List[str]] = {}
+
+    current_t = 0.0
+    for item in all_audio:
+        clip = item["clip"]
+        media = item["media"]
+        clip_start = item["start"]
+        clip_dur = item["duration"]
+        src_dur = item["sourceDuration"]
+        trim_start = item["trimStart"]
+        speed = item["speed"]
+        reverse = item["reverse"]
+        src_idx = input_index[media["id"]]
+
+        gap = clip_start - current_t
+        if gap > 0.001:
+            lbl = f"a{seg_idx}"
+            filter_parts.append(
+                f"anullsrc=r=48000:cl=stereo:d={_fmt(gap)}[{lbl}]"
+            )
+            audio_segments.append(f"[{lbl}]")
+            seg_idx += 1
+
+        key = _segment_key(item, src_idx)
+        if dedup.get(key):
+            audio_segments.append(dedup[key].pop(0))
+        else:
+            copies = key_counts[key]
+            labels = [f"[a{seg_idx + i}]" for i in range(copies)]
+            seg_idx += copies
+            info = info_by_media.get(media["id"], MediaInfo())
+            # Inputs seeked with -ss/-t already start and stop at the cut.
+            chain = [] if src_idx in seeks else [
+                f"atrim=start={_fmt(trim_start)}:duration={_fmt(src_dur)}"
+            ]
+            chain.append("asetpts=PTS-STARTPTS")
+            if reverse:
+                chain.append("areverse")
+            chain.extend(_atempo_chain(speed))
+            # concat negotiates the sample format; only resample/remix when needed.
+            if (info.sample_rate, info.channel_layout) != (48000, "stereo"):
+                chain.append("aformat=sample_fmts=fltp:sample_rates=48000:channel_layouts=stereo")
+            if copies > 1:
+                chain.append(f"asplit={copies}")
+            filter_parts.append(f"[{src_idx}:a]{','.join(chain)}{''.join(labels)}")
+            audio_segments.append(labels[0])
+            dedup[key] = labels[1:]
+        current_t = clip_start + clip_dur
+
+        print(f"[A-SEG] clip {clip['id'][:8]} src={src_idx} "
+              f"trim={_fmt(trim_start)}+{_fmt(clip_dur)} @timeline={_fmt(clip_start)}")
+
+    trail = end_t - current_t
+    if trail > 0.001:
+        lbl = f"a{seg_idx}"
+        filter_parts.append(
+            f"anullsrc=r=48000:cl=stereo:d={_fmt(trail)}[{lbl}]"
+        )
+        audio_segments.append(f"[{lbl}]")
+        seg_idx += 1
+
+    filter_parts.append(
+        f"{''.join(audio_segments)}concat=n={len(audio_segments)}:v=0:a=1[aout]"
+    )
+    return filter_parts
+
+
+# Parallel window rendering: one window per ~4 cores (x264/vp9 scale well up
+# to about that many threads each), each window at least this long.
+_SEGMENT_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+_SEGMENT_MIN_SECONDS = 10.0
+# Server-wide bound on concurrent window encodes, shared between renders.
+_SEGMENT_SEM = asyncio.Semaphore(_SEGMENT_WORKERS)
+
+
+def _plan_segment_windows(
+    all_video: List[Dict[str, Any]], output_duration: float, framerate: int
+) -> Optional[List[Tuple[float, float, List[Dict[str, Any]]]]]:
+    """Split the video timeline into contiguous windows of roughly equal length,
+    or return None when it isn't worth splitting.
+
+    Windows are cut at gaps where possible (the next window then opens on
+    black, which is nearly free to encode as a keyframe), otherwise at clip
+    starts.
+    """
+    if len(all_video) < 2 or _SEGMENT_WORKERS < 2:
+        return None
+    frame_dur = 1.0 / framerate
+    # Overlapping clips play back to back in the single graph, shifting what
+    # follows; windows cut at clip starts would not reproduce that.
+    prev_end = 0.0
+    for item in all_video:
+        clip_start = item["start"]
+        if clip_start < prev_end - frame_dur:
+            return None
+        prev_end = clip_start + item["duration"]
+    if prev_end > output_duration + frame_dur:
+        return None
+
+    count = min(_SEGMENT_WORKERS, int(output_duration // _SEGMENT_MIN_SECONDS))
+    if count < 2:
+        return None
+    target = output_duration / count
+
+    # One candidate cut before each clip after the first: the first frame
+    # boundary inside the gap before it if there is one, else its start
+    # snapped to the frame grid (each window's -r/-t covers whole frames, so
+    # off-grid cuts would drift the stitched video against the audio).
+    cuts: List[Tuple[float, int, bool]] = []
+    prev_end = all_video[0]["start"] + all_video[0]["duration"]
+    for i, item in enumerate(all_video[1:], 1):
+        gap_cut = math.ceil(prev_end * framerate - 1e-6) / framerate
+        if gap_cut + frame_dur <= item["start"]:
+            cuts.append((gap_cut, i, True))
+        else:
+            cuts.append((round(item["start"] * framerate) / framerate, i, False))
+        prev_end = item["start"] + item["duration"]
+
+    # Take the cut nearest each even boundary, a gap if one is reasonably
+    # close, so no window ends up with most of the timeline.
+    chosen: List[Tuple[float, int, bool]] = []
+    for k in range(1, count):
+        boundary = k * target
+        usable = [c for c in cuts if not chosen or c[1] > chosen[-1][1]]
+        if not usable:
+            break
+        gaps = [c for c in usable if c[2] and abs(c[0] - boundary) <= target / 4]
+        chosen.append(min(gaps or usable, key=lambda c: abs(c[0] - boundary)))
+
+    windows: List[Tuple[float, float, List[Dict[str, Any]]]] = []
+    w_start = 0.0
+    first = 0
+    for cut, i, _ in chosen:
+        windows.append((w_start, cut, all_video[first:i]))
+        w_start, first = cut, i
+    windows.append((w_start, output_duration, all_video[first:]))
+    return windows if len(windows) > 1 else None
+
+
+# Codecs that can be stream-copied into each output container.
+_COPY_VIDEO_CODECS = {"mp4": {"h264", "hevc", "av1"}, "webm": {"vp8", "vp9", "av1"}}
+_COPY_AUDIO_CODECS = {"mp4": {"aac", "mp3"}, "webm": {"opus", "vorbis"}}
+
+
+def _plain_picture(info: MediaInfo) -> bool:
+    """Whether frames are already 8-bit 4:2:0 with square pixels, as the encode
+    path would conform them; anything else must not be remuxed as-is."""
+    return info.pix_fmt == "yuv420p" and info.sar in ("1:1", None)
+
+
+def _video_signature(info: MediaInfo) -> tuple:
+    return (info.vcodec, info.width, info.height, info.fps)
+
+
+def _audio_signature(info: MediaInfo) -> tuple:
+    return (info.acodec, info.sample_rate, info.channel_layout)
+
+
+def _can_stream_copy(
+    all_video: List[Dict[str, Any]],
+    all_audio: List[Dict[str, Any]],
+    settings: Dict[str, Any],
+    info_by_media: Dict[str, MediaInfo],
+    output_duration: float,
+) -> bool:
+    """Whether the timeline can be produced by concat-demuxing its clips with -c copy.
+
+    Requires plain cuts (no speed/reverse) laid end to end without gaps, sources
+    that already match the requested size/framerate/container codecs, and an
+    audio timeline that is either empty or mirrors the video clips one to one.
+    Trims become inpoint/outpoint directives; a stream-copied cut restarts at
+    the keyframe before its in point, so the caller must also check
+    ``_cuts_on_keyframes``. The demuxer stops on decode timestamps, letting
+    reordered frames past an out point through, so only the last clip (whose
+    overrun the output -t drops) may be trimmed at its end.
+    """
+    if not all_video:
+        return False
+    output_format = settings["format"]
+    framerate = int(settings["framerate"])
+    frame_dur = 1.0 / framerate
+
+    current_t = 0.0
+    for item in all_video:
+        if item["speed"] != 1.0 or item["reverse"]:
+            return False
+        if item["trimEnd"] > 0 and item is not all_video[-1]:
+            return False
+        if item["start"] - current_t > frame_dur:
+            return False
+        current_t = item["start"] + item["duration"]
+    if output_duration - current_t > frame_dur:
+        return False
+
+    if all_audio:
+        if len(all_audio) != len(all_video):
+            return False
+        for v_item, a_item in zip(all_video, all_audio):
+            if a_item["media"]["id"] != v_item["media"]["id"]:
+                return False
+            if abs(a_item["start"] - v_item["start"]) > frame_dur:
+                return False
+            if any(a_item[k] != v_item[k] for k in ("trimStart", "trimEnd")):
+                return False
+            if a_item["speed"] != 1.0 or a_item["reverse"]:
+                return False
+
+    video_sigs = set()
+    audio_sigs = set()
+    for item in all_video:
+        info = info_by_media.get(item["media"]["id"], MediaInfo())
+        if info.video_streams != 1 or info.audio_streams > 1:
+            return False
+        if not _plain_picture(info):
+            return False
+        if (item["trimStart"] > 0 or item["trimEnd"] > 0) and info.start_time is None:
+            return False
+        if all_audio and not info.audio_streams:
+            return False
+        video_sigs.add(_video_signature(info))
+        if all_audio:
+            audio_sigs.add(_audio_signature(info))
+    if len(video_sigs) != 1 or len(audio_sigs) > 1:
+        return False
+
+    vcodec, w, h, fps = next(iter(video_sigs))
+    if vcodec not in _COPY_VIDEO_CODECS.get(output_format, set()):
+        return False
+    if w != int(settings["width"]) or h != int(settings["height"]) or fps != framerate:
+        return False
+    if audio_sigs:
+        acodec = next(iter(audio_sigs))[0]
+        if acodec not in _COPY_AUDIO_CODECS.get(output_format, set()):
+            return False
+    return True
+
+
+def _single_clip_copy(
+    all_video: List[Dict[str, Any]],
+    all_audio: List[Dict[str, Any]],
+    settings: Dict[str, Any],
+    info_by_media: Dict[str, MediaInfo],
+    output_duration: float,
+) -> Optional[Tuple[Dict[str, Any], bool, bool]]:
+    """Detect a timeline that is one (possibly trimmed) clip of one file.
+
+    Returns ``(item, with_video, with_audio)`` when the clip can be cut out with
+    -ss/-t and -c copy, otherwise None. A video clip may carry its linked audio
+    clip (same media, start and trims).
+    """
+    if len(all_video) > 1 or len(all_audio) > 1 or not (all_video or all_audio):
+        return None
+    if all_video and all_audio:
+        v_item, a_item = all_video[0], all_audio[0]
+        if a_item["media"]["id"] != v_item["media"]["id"]:
+            return None
+        if any(v_item[k] != a_item[k] for k in ("start", "trimStart", "trimEnd")):
+            return None
+    item = (all_video or all_audio)[0]
+    if item["speed"] != 1.0 or item["reverse"]:
+        return None
+    if all_audio and (all_audio[0]["speed"] != 1.0 or all_audio[0]["reverse"]):
+        return None
+
+    output_format = settings["format"]
+    framerate = int(settings["framerate"])
+    frame_dur = 1.0 / framerate
+    if item["start"] > frame_dur:
+        return None
+    if abs(output_duration - item["duration"]) > frame_dur:
+        return None
+
+    info = info_by_media.get(item["media"]["id"], MediaInfo())
+    if all_video:
+        if info.video_streams != 1 or info.vcodec not in _COPY_VIDEO_CODECS.get(output_format, set()):
+            return None
+        if (info.width, info.height) != (int(settings["width"]), int(settings["height"])):
+            return None
+        if info.fps != framerate or not _plain_picture(info):
+            return None
+    if all_audio:
+        if info.audio_streams < 1 or info.acodec not in _COPY_AUDIO_CODECS.get(output_format, set()):
+            return None
+    return item, bool(all_video), bool(all_audio)
+
+
+def _trim_copy_args(
+    item: Dict[str, Any], media_paths: Dict[str, str], with_video: bool, with_audio: bool
+) -> List[str]:
+    """-ss/-t stream-copy command (without output args) cutting one clip out of its file."""
+    args = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y",
+            "-ss", _fmt(item["trimStart"]), "-i", media_paths[item["media"]["id"]],
+            "-t", _fmt(item["sourceDuration"])]
+    if with_video:
+        args.extend(["-map", "0:v:0"])
+    if with_audio:
+        args.extend(["-map", "0:a:0"])
+    args.extend(["-c", "copy"])
+    return args
+
+
+async def _keyframe_at(path: str, t: float, framerate: int) -> bool:
+    """Whether the first video packet read after seeking to file timestamp ``t``
+    is a keyframe within half a frame of it (seeking lands on the keyframe at or
+    before ``t``)."""
+    try:
+        async with _PROBE_SEM:
+            proc = await asyncio.create_subprocess_exec(
+                "ffprobe", "-v", "error", "-select_streams", "v:0",
+                "-read_intervals", f"{_fmt(t)}%+#1",
+                "-show_entries", "packet=pts_time,flags", "-of", "json", path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            stdout, _ = await proc.communicate()
+        packets = json.loads(stdout).get("packets") or [{}]
+        packet = packets[0]
+        return "K" in packet.get("flags", "") and abs(float(packet["pts_time"]) - t) <= 0.5 / framerate
+    except Exception:
+        return False
+
+
+async def _cuts_on_keyframes(
+    all_video: List[Dict[str, Any]],
+    media_paths: Dict[str, str],
+    info_by_media: Dict[str, MediaInfo],
+    framerate: int,
+) -> bool:
+    """Whether every trimmed clip starts on a keyframe of its source.
+
+    Otherwise the copied packets from that keyframe up to the in point
+    bring back cut footage and overlap the previous clip's timestamps.
+    """
+    cuts = set()
+    for item in all_video:
+        if item["trimStart"] > 0:
+            start_time = info_by_media.get(item["media"]["id"], MediaInfo()).start_time
+            if start_time is None:
+                return False
+            cuts.add((media_paths[item["media"]["id"]], start_time + item["trimStart"]))
+    results = await asyncio.gather(*[_keyframe_at(path, t, framerate) for path, t in cuts])
+    return all(results)
+
+
+def _concat_copy_args(
+    all_video: List[Dict[str, Any]],
+    media_paths: Dict[str, str],
+    info_by_media: Dict[str, MediaInfo],
+    temp_dir: str,
+    with_audio: bool,
+    output_duration: float,
+) -> List[str]:
+    """Write a concat demuxer list for the timeline and return the -c copy command
+    (without output args).
+
+    inpoint/outpoint are file timestamps, so trims (relative to the start, as
+    for trim= and -ss) are offset by the source's start time.
+    """
+    list_path = Path(temp_dir) / "concat.txt"
+    lines = []
+    for item in all_video:
+        media_path = media_paths[item["media"]["id"]]
+        escaped = media_path.replace("'", "'\\''")
+        lines.append(f"file '{escaped}'")
+        offset = info_by_media.get(item["media"]["id"], MediaInfo()).start_time or 0.0
+        if item["trimStart"] > 0:
+            lines.append(f"inpoint {_fmt(offset + item['trimStart'])}")
+        if item["trimEnd"] > 0:
+            lines.append(f"outpoint {_fmt(offset + item['trimStart'] + item['sourceDuration'])}")
+    list_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    args: List[str] = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y",
+                       "-f", "concat", "-safe", "0", "-i", str(list_path), "-map", "0:v:0"]
+    if with_audio:
+        args.extend(["-map", "0:a:0"])
+    args.extend(["-c", "copy", "-t", str(output_duration)])
+    return args
+
+
+# Hardware encoders in order of preference; the software encoder is the fallback.
+_HW_ENCODERS = {
+    "mp4": ["h264_nvenc", "h264_qsv", "h264_videotoolbox", "h264_vaapi"],
+    "webm": ["av1_nvenc", "vp9_qsv", "vp9_vaapi"],
+}
+_SW_ENCODERS = {"mp4": "libx264", "webm": "libvpx-vp9"}
+_VAAPI_DEVICE = "/dev/dri/renderD128"
+_ENCODER_PROBE_TIMEOUT = 10.0
+_usable_encoders: Optional[Set[str]] = None
+_detect_lock = asyncio.Lock()
+
+
+def _is_vaapi(encoder: str) -> bool:
+    return encoder.endswith("_vaapi")
+
+
+async def _encoder_works(encoder: str) -> bool:
+    """Listed encoders may lack a device/driver, so try a one-frame encode."""
+    args = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error"]
+    if _is_vaapi(encoder):
+        args.extend(["-vaapi_device", _VAAPI_DEVICE])
+    args.extend(["-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1", "-frames:v", "1"])
+    if _is_vaapi(encoder):
+        args.extend(["-vf", "format=nv12,hwupload"])
+    args.extend(["-c:v", encoder, "-f", "null", "-"])
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+    except Exception:
+        return False
+    try:
+        return await asyncio.wait_for(proc.wait(), _ENCODER_PROBE_TIMEOUT) == 0
+    except asyncio.TimeoutError:
+        # A wedged driver must not hold up every render waiting on detection.
+        proc.kill()
+        await proc.wait()
+        return False
+
+
+async def _detect_hw_encoders() -> Set[str]:
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-encoders",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await proc.communicate()
+    except Exception:
+        return set()
+    listed = {line.split()[1] for line in stdout.decode("utf-8", "replace").splitlines()
+              if len(line.split()) > 1}
+    candidates = [enc for encs in _HW_ENCODERS.values() for enc in encs if enc in listed]
+    works = await asyncio.gather(*[_encoder_works(enc) for enc in candidates])
+    return {enc for enc, ok in zip(candidates, works) if ok}
+
+
+# ffmpeg 7 loads any option's value from a file with "-/opt FILE" and
+# deprecates -filter_complex_script; older builds only have the latter.
+_filter_script_option = "-filter_complex_script"
+
+
+async def _detect_filter_script_option() -> str:
+    """Use ``-/filter_complex`` when this ffmpeg accepts it."""
+    fd, script_path = tempfile.mkstemp(prefix="vibe-filter-probe-", suffix=".filter")
+    script = Path(script_path)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            fh.write("nullsrc=s=16x16:d=0.04")
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error",
+            "-/filter_complex", str(script), "-f", "null", "-",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except Exception:
+        script.unlink(missing_ok=True)
+        return "-filter_complex_script"
+    try:
+        ok = await asyncio.wait_for(proc.wait(), _ENCODER_PROBE_TIMEOUT) == 0
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        ok = False
+    finally:
+        script.unlink(missing_ok=True)
+    return "-/filter_complex" if ok else "-filter_complex_script"
+
+
+async def _select_video_encoder(output_format: str) -> str:
+    global _usable_encoders
+    # Concurrent first renders share one detection run (which also settles
+    # how filter scripts are passed).
+    global _filter_script_option
+    async with _detect_lock:
+        if _usable_encoders is None:
+            _usable_encoders, _filter_script_option = await asyncio.gather(
+                _detect_hw_encoders(), _detect_filter_script_option()
+            )
+            print(f"[ENC] hardware encoders available: {sorted(_usable_encoders) or 'none'}")
+    for encoder in _HW_ENCODERS.get(output_format, []):
+        if encoder in _usable_encoders:
+            return encoder
+    return _SW_ENCODERS.get(output_format, "libvpx-vp9")
+
+
+def _decode_hwaccel(encoder: str) -> str:
+    """Decoder hwaccel matching the selected encoder's device.
+
+    Decoded frames are downloaded to system memory, so the CPU filter graph
+    (pad, colour gaps, subtitles, concat) works unchanged.
+    """
+    if encoder.endswith("_nvenc"):
+        return "cuda"
+    if encoder.endswith("_qsv"):
+        return "qsv"
+    if encoder.endswith("_videotoolbox"):
+        return "videotoolbox"
+    if _is_vaapi(encoder):
+        return "vaapi"
+    return "auto"
+
+
+# x264/vp9 stop scaling well past ~16 threads.
+_MAX_ENCODER_THREADS = 16
+
+
+def _video_encoder_args(
+    encoder: str, bitrate: int, width: int, framerate: int, threads: Optional[int] = None
+) -> List[str]:
+    """Encoder options; ``threads`` defaults to all cores (capped)."""
+    nthreads = max(1, min(threads or os.cpu_count() or 1, _MAX_ENCODER_THREADS))
+    if encoder == "libx264":
+        opts = ["-preset", "ultrafast", "-tune", "fastdecode", "-threads", str(nthreads)]
+    elif encoder == "libvpx-vp9":
+        tile_columns = max(0, int(math.log2(max(1, width // 256))))
+        opts = ["-speed", "4", "-row-mt", "1", "-tile-columns", str(tile_columns),
+                "-frame-parallel", "1", "-threads", str(nthreads)]
+    elif encoder.endswith("_nvenc"):
+        # p4 is NVENC's balanced preset; it is still far faster than x264.
+        opts = ["-preset", "p4", "-rc", "vbr"]
+    elif encoder.endswith("_qsv"):
+        opts = ["-preset", "veryfast"]
+    elif encoder.endswith("_videotoolbox"):
+        opts = ["-realtime", "1"]
+    elif _is_vaapi(encoder):
+        opts = ["-rc_mode", "VBR"]
+    else:
+        opts = []
+    # Regular keyframes keep the output cuttable by the stream-copy paths.
+    return ["-c:v", encoder, *opts, "-g", str(framerate * 2), "-b:v", f"{bitrate}k"]
+
+
+def _filter_script_args(filter_parts: List[str], temp_dir: str, name: str) -> List[str]:
+    """Write the graph to a file so large timelines don't hit argv limits."""
+    script_path = Path(temp_dir) / f"{name}.filter"
+    script_path.write_text(";\n".join(filter_parts), encoding="utf-8")
+    return [_filter_script_option, str(script_path)]
+
+
+def _audio_encoder_args(output_format: str) -> List[str]:
+    if output_format == "mp4":
+        return ["-c:a", "aac", "-b:a", "128k"]
+    return ["-c:a", "libopus", "-b:a", "128k"]
+
+
+# Cap concurrent ffmpeg processes so simultaneous renders don't oversubscribe cores.
+_FFMPEG_SEM = asyncio.Semaphore(os.cpu_count() or 4)
+
+
+_LOG_TAIL_BYTES = 4096
+
+
+def _ffmpeg_error(log_path: str) -> HTTPException:
+    """Build the 500 for a failed ffmpeg run from the tail of its stderr log."""
+    try:
+        fd = os.open(log_path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            tail = os.pread(fd, _LOG_TAIL_BYTES, max(0, size - _LOG_TAIL_BYTES))
+        finally:
+            os.close(fd)
+    except OSError:
+        tail = b""
+    stderr = tail.decode("utf-8", "replace").strip() or "Unknown ffmpeg error"
+    err_lines = "\n".join(stderr.splitlines()[-25:])
+    return HTTPException(status_code=500, detail=f"FFmpeg failed:\n{err_lines}")
+
+
+_PROGRESS_INTERVAL = 5.0
+
+
+async def _log_progress(stream: asyncio.StreamReader, name: str) -> None:
+    """Consume ``-progress`` key=value blocks, logging position every few seconds."""
+    loop = asyncio.get_running_loop()
+    last_report = loop.time()
+    out_time = ""
+    async for raw in stream:
+        key, _, value = raw.decode("ascii", "replace").strip().partition("=")
+        if key == "out_time":
+            out_time = value
+        elif key == "progress" and loop.time() - last_report >= _PROGRESS_INTERVAL:
+            last_report = loop.time()
+            print(f"[PROG] {name} at {out_time}")
+
+
+async def _run_ffmpeg(args: List[str], out_path: str) -> None:
+    print(f"[CMD] {' '.join(args[:6])} ... ({len(args)} args total)")
+    # stderr goes to a file so long renders can't pile it up in memory.
+    log_path = f"{out_path}.log"
+    async with _FFMPEG_SEM:
+        with open(log_path, "wb") as log:
+            # Progress goes to stdout (unused, the output is a file) as key=value lines.
+            proc = await asyncio.create_subprocess_exec(
+                args[0], "-progress", "pipe:1", *args[1:],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=log,
+            )
+        try:
+            await _log_progress(proc.stdout, Path(out_path).name)  # type: ignore[arg-type]
+            await proc.wait()
+        except asyncio.CancelledError:
+            # A sibling job failed or the render was abandoned.
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    if proc.returncode != 0 or not os.path.exists(out_path):
+        raise _ffmpeg_error(log_path)
+
+
+async def _run_segment(args: List[str], out_path: str) -> None:
+    async with _SEGMENT_SEM:
+        await _run_ffmpeg(args, out_path)
+
+
+async def _run_jobs(jobs: List[Awaitable[None]]) -> None:
+    """Run ffmpeg jobs concurrently; the first failure cancels the rest and is re-raised."""
+    if hasattr(asyncio, "TaskGroup"):  # 3.11+
+        try:
+            async with asyncio.TaskGroup() as group:
+                for job in jobs:
+                    group.create_task(job)
+        except BaseExceptionGroup as eg:  # noqa: F821
+            raise eg.exceptions[0]
+        return
+    tasks = [asyncio.ensure_future(job) for job in jobs]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+_STREAM_CHUNK = 64 * 1024
+
+
+class _OnCloseMixin:
+    """Runs ``on_close`` once the response has been sent or abandoned.
+
+    Starlette never starts a streaming body whose client is already gone and
+    skips background tasks after a disconnect, so neither can own cleanup.
+    """
+
+    on_close: Optional[Callable[[], Awaitable[None]]] = None
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        try:
+            await super().__call__(scope, receive, send)  # type: ignore[misc]
+        finally:
+            if self.on_close is not None:
+                await self.on_close()
+
+
+class _ClosingStreamingResponse(_OnCloseMixin, StreamingResponse):
+    pass
+
+
+class _ClosingFileResponse(_OnCloseMixin, FileResponse):
+    pass
+
+
+# Fragmented MP4 needs no seekable output, so it can be written to a pipe.
+_PIPE_OUTPUT_ARGS = ["-f", "mp4", "-movflags", "+frag_keyframe+empty_moov+default_base_moof", "pipe:1"]
+
+
+async def _ffmpeg_response(
+    args: List[str],
+    output_format: str,
+    temp_dir: str,
+    on_close: Optional[Callable[[], Awaitable[None]]] = None,
+) -> Response:
+    """Run the final ffmpeg pass and return its output as the response.
+
+    MP4 is streamed to the client as it is produced, after waiting for the
+    first chunk so failures that happen before any output (bad graph,
+    unreadable input) still surface as an HTTP 500. A failure after that
+    truncates the 200 response. WebM is rendered to a file first: Matroska
+    written to a pipe gets no Duration or Cues, so the download would not be
+    seekable. ``on_close`` runs once the response has been sent or
+    abandoned, not when this raises.
+    """
+    mime = "video/mp4" if output_format == "mp4" else "video/webm"
+    filename = f"rendered.{output_format}"
+    if output_format != "mp4":
+        out_path = str(Path(temp_dir) / filename)
+        await _run_ffmpeg([*args, "-f", output_format, out_path], out_path)
+        response = _ClosingFileResponse(out_path, media_type=mime, filename=filename)
+        response.on_close = on_close
+        return response
+
+    args = [*args, *_PIPE_OUTPUT_ARGS]
+    print(f"[CMD] {' '.join(args[:6])} ... ({len(args)} args total)")
+    log_path = str(Path(temp_dir) / "ffmpeg.log")
+    await _FFMPEG_SEM.acquire()
+    try:
+        with open(log_path, "wb") as log:
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=log,
+            )
+    except Exception:
+        _FFMPEG_SEM.release()
+        raise
+    try:
+        first = await proc.stdout.read(_STREAM_CHUNK)  # type: ignore[union-attr]
+        if not first:
+            await proc.wait()
+            raise _ffmpeg_error(log_path)
+    except BaseException:
+        # Includes cancellation while waiting for output.
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        _FFMPEG_SEM.release()
+        raise
+
+    async def body():
+        yield first
+        while chunk := await proc.stdout.read(_STREAM_CHUNK):  # type: ignore[union-attr]
+            yield chunk
+        await proc.wait()
+        if proc.returncode != 0:
+            print(f"[ERR] ffmpeg exited {proc.returncode} mid-stream:\n"
+                  f"{_ffmpeg_error(log_path).detail}")
+
+    async def close() -> None:
+        # The body may never have started, so the process is owned here.
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        _FFMPEG_SEM.release()
+        if on_close is not None:
+            await on_close()
+
+    response = _ClosingStreamingResponse(
+        body(),
+        media_type=mime,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
+    response.on_close = close
+    return response
 
 
-def _escape_drawtext_value(value: str) -> str:
-    return value.replace("\\", "\\\\").replace(":", "\\:").replace("'", "\\'")
+async def _remove_tree(path: str) -> None:
+    """Delete a render's temp dir off the event loop."""
+    await asyncio.to_thread(shutil.rmtree, path, True)
+
+
+# Renders admitted at once; each already spreads its ffmpeg work over the
+# cores, so more in flight just contend for them.
+_MAX_RENDERS = max(1, int(os.environ.get("VIBE_MAX_CONCURRENT_RENDERS", (os.cpu_count() or 1) // 4)))
+_RENDER_SEM = asyncio.Semaphore(_MAX_RENDERS)
+
+
+# Payloads above this size are parsed off the event loop.
+_JSON_THREAD_THRESHOLD = 256 * 1024
+
+
+async def _loads_json(raw: str) -> Any:
+    if len(raw) > _JSON_THREAD_THRESHOLD:
+        return await asyncio.to_thread(orjson.loads, raw)
+    return orjson.loads(raw)
 
 
 @app.get("/health")
@@ -120,14 +1628,26 @@ async def render(request: Request, background_tasks: BackgroundTasks):
         raise HTTPException(status_code=400, detail="Missing project/settings")
 
     try:
-        project = json.loads(project_raw)  # type: ignore[arg-type]
-        settings = json.loads(settings_raw)  # type: ignore[arg-type]
+        project = await _loads_json(project_raw)  # type: ignore[arg-type]
+        settings = await _loads_json(settings_raw)  # type: ignore[arg-type]
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON payload: {e}")
 
     temp_dir = tempfile.mkdtemp(prefix="vibe-render-")
+    holding_slot = False
+    media_paths: Dict[str, str] = {}
+
+    async def finish() -> None:
+        # Runs once the response is sent or abandoned, even if the client
+        # left before the body started (see _OnCloseMixin).
+        _RENDER_SEM.release()
+        _unpin_media(media_paths.values())
+        await _remove_tree(temp_dir)
+
     try:
-        media_paths: Dict[str, str] = {}
+        media_ids: List[str] = []
+        media_keys: Dict[str, str] = {}
+        saves = []
         for key, value in form.multi_items():
             if not key.startswith("media_"):
                 continue
@@ -135,14 +1655,28 @@ async def render(request: Request, background_tasks: BackgroundTasks):
             upload = value
             filename = _safe_name(getattr(upload, "filename", f"{media_id}.bin"))
             target = Path(temp_dir) / f"{media_id}_{filename}"
-            data = await upload.read()  # type: ignore[union-attr]
-            target.write_bytes(data)
-            media_paths[media_id] = str(target)
+            saves.append(asyncio.to_thread(_save_upload, upload, target))
+            media_ids.append(media_id)
+        for media_id, (path, digest) in zip(media_ids, await asyncio.gather(*saves)):
+            media_paths[media_id] = path
+            media_keys[media_id] = digest
+        # Drop the spooled upload temp files now rather than after the render.
+        await form.close()
+        background_tasks.add_task(_prune_media_cache)
 
         media_map = {m["id"]: m for m in project["mediaFiles"]}
-        stream_types_by_media: Dict[str, Set[str]] = {}
-        for media_id, media_path in media_paths.items():
-            stream_types_by_media[media_id] = _probe_stream_types(media_path)
+        probe_cache: Dict[str, Any] = {}
+        if any(key not in _PROBE_MEMO for key in media_keys.values()):
+            probe_cache = await asyncio.to_thread(_load_probe_cache)
+        # New entries or hits moved to the end both need writing back.
+        cache_order = list(probe_cache)
+        results = await asyncio.gather(
+            *[_probe_media_info(path, media_keys[media_id], probe_cache)
+              for media_id, path in media_paths.items()]
+        )
+        info_by_media: Dict[str, MediaInfo] = dict(zip(media_paths.keys(), results))
+        if list(probe_cache) != cache_order:
+            background_tasks.add_task(_save_probe_cache, dict(probe_cache))
 
         video_tracks = [t for t in project["tracks"] if t["type"] == "video"]
         audio_tracks = [t for t in project["tracks"] if t["type"] == "audio"]
@@ -170,26 +1704,26 @@ async def render(request: Request, background_tasks: BackgroundTasks):
             for clip in track["clips"]:
                 media = media_map.get(clip["mediaId"])
                 if media:
-                    stream_types = stream_types_by_media.get(media["id"], set())
+                    stream_types = info_by_media.get(media["id"], MediaInfo()).stream_types
                     has_video_stream = "video" in stream_types or (not stream_types and media.get("type") == "video")
                     if not has_video_stream:
                         print(f"[SKIP] clip {clip.get('id', '?')} has no video stream in media {media['id']}")
                         continue
-                    all_video.append({"clip": clip, "media": media, "trackIndex": ti})
-        all_video.sort(key=lambda x: float(x["clip"]["startTime"]))
+                    all_video.append(_timeline_item(clip, media, ti))
+        all_video.sort(key=lambda x: x["start"])
 
         all_audio: List[Dict[str, Any]] = []
         for ti, track in enumerate(audio_tracks):
             for clip in track["clips"]:
                 media = media_map.get(clip["mediaId"])
                 if media:
-                    stream_types = stream_types_by_media.get(media["id"], set())
+                    stream_types = info_by_media.get(media["id"], MediaInfo()).stream_types
                     has_audio_stream = "audio" in stream_types or (not stream_types and media.get("type") == "audio")
                     if not has_audio_stream:
                         print(f"[SKIP] clip {clip.get('id', '?')} has no audio stream in media {media['id']}")
                         continue
-                    all_audio.append({"clip": clip, "media": media, "trackIndex": ti})
-        all_audio.sort(key=lambda x: float(x["clip"]["startTime"]))
+                    all_audio.append(_timeline_item(clip, media, ti))
+        all_audio.sort(key=lambda x: x["start"])
 
         if not all_video and not all_audio and not text_overlays:
             raise HTTPException(status_code=400, detail="No clips to render")
@@ -200,232 +1734,180 @@ async def render(request: Request, background_tasks: BackgroundTasks):
         duration = float(project["duration"])
         output_duration = max(duration, 1.0 / framerate)
 
+        output_format = settings["format"]
+        bitrate = int(settings["bitrate"])
+
+        for media_id in {item["media"]["id"] for item in chain(all_video, all_audio)}:
+            if media_id not in media_paths:
+                raise HTTPException(
+                    status_code=400, detail=f"Missing uploaded media for id {media_id}"
+                )
+
+        # Held until the output stream closes; released below on failure.
+        if _RENDER_SEM.locked():
+            print("[QUEUE] waiting for a free render slot")
+        await _RENDER_SEM.acquire()
+        holding_slot = True
+
+        # --------------- Fast path: one clip, cut with -ss/-t + stream copy ---------------
+        single = None if text_overlays else _single_clip_copy(
+            all_video, all_audio, settings, info_by_media, output_duration
+        )
+        if single and single[1] and not await _cuts_on_keyframes(
+            [single[0]], media_paths, info_by_media, framerate
+        ):
+            # Copying from a mid-GOP trim would start at the keyframe before it,
+            # and fragmented MP4 has no edit list to hide those frames.
+            single = None
+        if single:
+            item, with_video, with_audio = single
+            print(f"[FAST] stream-copying single clip {item['clip']['id'][:8]}")
+            args = _trim_copy_args(item, media_paths, with_video, with_audio)
+            response = await _ffmpeg_response(args, output_format, temp_dir, finish)
+            return response
+
+        # --------------- Fast path: concat demuxer + stream copy ---------------
+        # Plain cuts of matching codec/params laid end to end need no decode
+        # at all; the concat demuxer trims and remuxes their packets.
+        if not text_overlays and _can_stream_copy(
+            all_video, all_audio, settings, info_by_media, output_duration
+        ) and await _cuts_on_keyframes(all_video, media_paths, info_by_media, framerate):
+            print(f"[FAST] stream-copying {len(all_video)} clip(s) via concat demuxer")
+            args = _concat_copy_args(
+                all_video, media_paths, info_by_media, temp_dir, bool(all_audio), output_duration
+            )
+            response = await _ffmpeg_response(args, output_format, temp_dir, finish)
+            return response
+
+        video_encoder = await _select_video_encoder(output_format)
+        hwaccel = _decode_hwaccel(video_encoder)
+
+        # --------------- Parallel path: encode windows, then stitch ---------------
+        # Software encoders leave cores idle on one long graph; render
+        # contiguous windows of the video timeline concurrently instead.
+        windows = None
+        if video_encoder in _SW_ENCODERS.values():
+            windows = _plan_segment_windows(all_video, output_duration, framerate)
+        if windows:
+            print(f"[SEG] rendering {len(windows)} window(s) in parallel")
+            # Split the cores between concurrently encoding windows.
+            encoder_threads = max(1, (os.cpu_count() or 1) // _SEGMENT_WORKERS)
+            video_jobs = []
+            seg_paths = []
+            for i, (w_start, w_end, items) in enumerate(windows):
+                seg_path = str(Path(temp_dir) / f"seg{i:04d}.mkv")
+                input_args, input_index, seeks = _input_args(items, media_paths, hwaccel)
+                parts = _video_timeline_filters(
+                    items, input_index, seeks, info_by_media, width, height, framerate, w_start, w_end
+                )
+                text_parts, video_out = _text_overlay_filters(
+                    text_overlays, "vout", w_start, w_end, width, height, temp_dir, f"seg{i:04d}"
+                )
+                seg_args = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y",
+                            "-filter_complex_threads", str(encoder_threads), *input_args,
+                            *_filter_script_args(parts + text_parts, temp_dir, f"seg{i:04d}"),
+                            "-map", f"[{video_out}]", "-an",
+                            *_video_encoder_args(video_encoder, bitrate, width, framerate,
+                                                 encoder_threads),
+                            "-r", str(framerate), "-t", _fmt(w_end - w_start), seg_path]
+                video_jobs.append(_run_segment(seg_args, seg_path))
+                seg_paths.append(seg_path)
+
+            audio_path = str(Path(temp_dir) / "audio.mka")
+            jobs = list(video_jobs)
+            if all_audio:
+                input_args, input_index, seeks = _input_args(all_audio, media_paths, hwaccel)
+                parts = _audio_timeline_filters(
+                    all_audio, input_index, seeks, info_by_media, output_duration
+                )
+                audio_args = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y",
+                              *input_args,
+                              *_filter_script_args(parts, temp_dir, "audio"),
+                              "-map", "[aout]", "-vn",
+                              *_audio_encoder_args(output_format),
+                              "-t", str(output_duration), audio_path]
+                jobs.append(_run_ffmpeg(audio_args, audio_path))
+            await _run_jobs(jobs)
+
+            list_path = Path(temp_dir) / "segments.txt"
+            list_path.write_text("".join(f"file '{p}'\n" for p in seg_paths), encoding="utf-8")
+            args = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y",
+                    "-f", "concat", "-safe", "0", "-i", str(list_path)]
+            if all_audio:
+                args.extend(["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"])
+            args.extend(["-c", "copy", "-t", str(output_duration)])
+            response = await _ffmpeg_response(args, output_format, temp_dir, finish)
+            return response
+
         # --------------- Inputs (dedup by file path) ---------------
-        args: List[str] = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
-        input_index: Dict[str, int] = {}
-        path_to_idx: Dict[str, int] = {}
-        idx = 0
-        for item in [*all_video, *all_audio]:
-            media_id = item["media"]["id"]
-            media_path = media_paths.get(media_id)
-            if not media_path:
-                raise HTTPException(status_code=400, detail=f"Missing uploaded media for id {media_id}")
-            if media_path not in path_to_idx:
-                args.extend(["-i", media_path])
-                path_to_idx[media_path] = idx
-                idx += 1
-            input_index[media_id] = path_to_idx[media_path]
+        # The graph (decode fan-out, scale, subtitles, concat) can bottleneck
+        # before the encoder does, so let it use every core too.
+        args: List[str] = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-y",
+                           "-filter_complex_threads", str(os.cpu_count() or 1)]
+        if _is_vaapi(video_encoder):
+            args.extend(["-vaapi_device", _VAAPI_DEVICE])
+        input_args, input_index, seeks = _input_args(chain(all_video, all_audio), media_paths, hwaccel)
+        args.extend(input_args)
 
         # --------------- Build filter graph using concat ---------------
         # Instead of overlay (which consumes the overlay stream while disabled,
         # causing desync), we build the timeline by concatenating segments
         # (gaps filled with black/silence, clips trimmed from source) in order.
-
         filter_parts: List[str] = []
-        seg_idx = 0
-        frame_dur = 1.0 / framerate
-
-        # --- VIDEO TIMELINE ---
-        video_segments: List[str] = []
+        has_video = bool(all_video or text_overlays)
         if all_video:
-            current_t = 0.0
-            for item in all_video:
-                clip = item["clip"]
-                media = item["media"]
-                clip_start = float(clip["startTime"])
-                clip_dur = _clip_duration(clip, media)
-                src_dur = _clip_source_duration(clip, media)
-                trim_start = float(clip["trimStart"])
-                speed = max(0.01, float(clip.get("speed", 1.0)))
-                reverse = bool(clip.get("reverse", False))
-                src_idx = input_index[media["id"]]
-
-                gap = clip_start - current_t
-                if gap > frame_dur:
-                    lbl = f"s{seg_idx}"
-                    filter_parts.append(
-                        f"color=c=black:s={width}x{height}:r={framerate}:d={_fmt(gap)},"
-                        f"format=yuv420p[{lbl}]"
-                    )
-                    video_segments.append(f"[{lbl}]")
-                    seg_idx += 1
-
-                lbl = f"s{seg_idx}"
-                video_effects = ["reverse"] if reverse else []
-                video_effects.append(f"setpts=(PTS-STARTPTS)/{_fmt(speed)}")
-                filter_parts.append(
-                    f"[{src_idx}:v]trim=start={_fmt(trim_start)}:duration={_fmt(src_dur)},"
-                    f"{','.join(video_effects)},fps={framerate},"
-                    f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
-                    f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,"
-                    f"format=yuv420p,setsar=1[{lbl}]"
-                )
-                video_segments.append(f"[{lbl}]")
-                seg_idx += 1
-                current_t = clip_start + clip_dur
-
-                print(f"[V-SEG] clip {clip['id'][:8]} src={src_idx} "
-                      f"trim={_fmt(trim_start)}+{_fmt(clip_dur)} @timeline={_fmt(clip_start)}")
-
-            trail = output_duration - current_t
-            if trail > frame_dur:
-                lbl = f"s{seg_idx}"
-                filter_parts.append(
-                    f"color=c=black:s={width}x{height}:r={framerate}:d={_fmt(trail)},"
-                    f"format=yuv420p[{lbl}]"
-                )
-                video_segments.append(f"[{lbl}]")
-                seg_idx += 1
-
-            filter_parts.append(
-                f"{''.join(video_segments)}concat=n={len(video_segments)}:v=1:a=0[vout]"
-            )
+            filter_parts.extend(_video_timeline_filters(
+                all_video, input_index, seeks, info_by_media, width, height, framerate, 0.0,
+                output_duration,
+            ))
         elif text_overlays:
             filter_parts.append(
-                f"color=c=black:s={width}x{height}:r={framerate}:d={_fmt(output_duration)},"
-                f"format=yuv420p[vout]"
+                f"{_black_frames(width, height, framerate, output_duration)}[vout]"
             )
-            video_segments.append("[vout]")
-
-        # --- TEXT OVERLAYS ---
-        has_text_filters = False
-        if text_overlays:
-            source_label = "vout"
-            for i, item in enumerate(text_overlays):
-                overlay = item["overlay"]
-                content = _escape_drawtext_text(str(overlay.get("content", "")))
-                if content == "":
-                    continue
-
-                color = _escape_drawtext_value(str(overlay.get("color", "#ffffff")))
-                font_family = _escape_drawtext_value(str(overlay.get("fontFamily", "Arial")))
-                x_norm = _clamp(float(overlay.get("x", 0.5)), 0.0, 1.0)
-                y_norm = _clamp(float(overlay.get("y", 0.85)), 0.0, 1.0)
-                font_size = max(8, int(float(overlay.get("fontSize", 48))))
-                align = str(overlay.get("align", "center")).lower()
-
-                if align == "left":
-                    draw_x = f"w*{x_norm:.4f}"
-                elif align == "right":
-                    draw_x = f"w*{x_norm:.4f}-text_w"
-                else:
-                    draw_x = f"w*{x_norm:.4f}-text_w/2"
-                draw_y = f"h*{y_norm:.4f}-text_h/2"
-
-                start_t = _fmt(float(item["start"]))
-                end_t = _fmt(float(item["end"]))
-                bg_color = overlay.get("backgroundColor")
-                box_opts = ""
-                if isinstance(bg_color, str) and bg_color.strip():
-                    box_opts = f":box=1:boxcolor={_escape_drawtext_value(bg_color.strip())}:boxborderw=8"
-
-                out_label = "vout_text" if i == len(text_overlays) - 1 else f"vtxt{i}"
-                filter_parts.append(
-                    f"[{source_label}]drawtext=text='{content}':fontcolor={color}:fontsize={font_size}:"
-                    f"x={draw_x}:y={draw_y}:font='{font_family}':"
-                    f"enable='between(t,{start_t},{end_t})'{box_opts}[{out_label}]"
-                )
-                source_label = out_label
-                has_text_filters = True
-
-        # --- AUDIO TIMELINE ---
-        audio_segments: List[str] = []
+        text_parts, video_out = _text_overlay_filters(
+            text_overlays, "vout", 0.0, output_duration, width, height, temp_dir, "overlays"
+        )
+        filter_parts.extend(text_parts)
         if all_audio:
-            current_t = 0.0
-            for item in all_audio:
-                clip = item["clip"]
-                media = item["media"]
-                clip_start = float(clip["startTime"])
-                clip_dur = _clip_duration(clip, media)
-                src_dur = _clip_source_duration(clip, media)
-                trim_start = float(clip["trimStart"])
-                speed = max(0.01, float(clip.get("speed", 1.0)))
-                reverse = bool(clip.get("reverse", False))
-                src_idx = input_index[media["id"]]
-
-                gap = clip_start - current_t
-                if gap > 0.001:
-                    lbl = f"s{seg_idx}"
-                    filter_parts.append(
-                        f"anullsrc=r=48000:cl=stereo:d={_fmt(gap)},"
-                        f"aformat=sample_fmts=fltp:sample_rates=48000:channel_layouts=stereo[{lbl}]"
-                    )
-                    audio_segments.append(f"[{lbl}]")
-                    seg_idx += 1
-
-                lbl = f"s{seg_idx}"
-                audio_effects = ["areverse"] if reverse else []
-                audio_effects.extend(_atempo_chain(speed))
-                filter_parts.append(
-                    f"[{src_idx}:a]atrim=start={_fmt(trim_start)}:duration={_fmt(src_dur)},"
-                    f"asetpts=PTS-STARTPTS,{','.join(audio_effects)},"
-                    f"aformat=sample_fmts=fltp:sample_rates=48000:channel_layouts=stereo[{lbl}]"
-                )
-                audio_segments.append(f"[{lbl}]")
-                seg_idx += 1
-                current_t = clip_start + clip_dur
-
-                print(f"[A-SEG] clip {clip['id'][:8]} src={src_idx} "
-                      f"trim={_fmt(trim_start)}+{_fmt(clip_dur)} @timeline={_fmt(clip_start)}")
-
-            trail = output_duration - current_t
-            if trail > 0.001:
-                lbl = f"s{seg_idx}"
-                filter_parts.append(
-                    f"anullsrc=r=48000:cl=stereo:d={_fmt(trail)},"
-                    f"aformat=sample_fmts=fltp:sample_rates=48000:channel_layouts=stereo[{lbl}]"
-                )
-                audio_segments.append(f"[{lbl}]")
-                seg_idx += 1
-
-            filter_parts.append(
-                f"{''.join(audio_segments)}concat=n={len(audio_segments)}:v=0:a=1[aout]"
+            filter_parts.extend(
+                _audio_timeline_filters(all_audio, input_index, seeks, info_by_media, output_duration)
             )
 
         # --------------- Assemble command ---------------
+        if has_video and _is_vaapi(video_encoder):
+            filter_parts.append(f"[{video_out}]format=nv12,hwupload[venc]")
+            video_out = "venc"
         if filter_parts:
-            args.extend(["-filter_complex", ";".join(filter_parts)])
-        if video_segments:
-            args.extend(["-map", "[vout_text]" if has_text_filters else "[vout]"])
-        if audio_segments:
+            args.extend(_filter_script_args(filter_parts, temp_dir, "render"))
+        if has_video:
+            args.extend(["-map", f"[{video_out}]"])
+        if all_audio:
             args.extend(["-map", "[aout]"])
 
-        output_format = settings["format"]
-        bitrate = int(settings["bitrate"])
-        out_name = f"output.{output_format}"
-        out_path = str(Path(temp_dir) / out_name)
-
-        if video_segments:
-            if output_format == "mp4":
-                args.extend(["-c:v", "libx264", "-preset", "ultrafast",
-                             "-tune", "fastdecode", "-movflags", "+faststart"])
-            else:
-                args.extend(["-c:v", "libvpx-vp9", "-speed", "4", "-row-mt", "1"])
-            args.extend(["-b:v", f"{bitrate}k", "-r", str(framerate)])
+        if has_video:
+            args.extend(_video_encoder_args(video_encoder, bitrate, width, framerate))
+            args.extend(["-r", str(framerate)])
 
-        if audio_segments:
-            if output_format == "mp4":
-                args.extend(["-c:a", "aac", "-b:a", "128k"])
-            else:
-                args.extend(["-c:a", "libopus", "-b:a", "128k"])
-
-        args.extend(["-t", str(output_duration), out_path])
-
-        print(f"[CMD] {' '.join(args[:6])} ... ({len(args)} args total)")
-        proc = subprocess.run(args, capture_output=True, text=True)
-        if proc.returncode != 0 or not os.path.exists(out_path):
-            stderr = (proc.stderr or "Unknown ffmpeg error").strip()
-            err_lines = "\n".join(stderr.splitlines()[-25:]) if stderr else "Unknown ffmpeg error"
-            raise HTTPException(status_code=500, detail=f"FFmpeg failed:\n{err_lines}")
-
-        background_tasks.add_task(shutil.rmtree, temp_dir, True)
-        mime = "video/mp4" if output_format == "mp4" else "video/webm"
-        return FileResponse(out_path, media_type=mime, filename=f"rendered.{output_format}")
-    except HTTPException:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        if all_audio:
+            args.extend(_audio_encoder_args(output_format))
+
+        args.extend(["-t", str(output_duration)])
+
+        response = await _ffmpeg_response(args, output_format, temp_dir, finish)
+        return response
+    except (HTTPException, asyncio.CancelledError):
+        # Cancelled when the server drops a request whose client went away
+        # before any response existed to own the cleanup.
+        if holding_slot:
+            _RENDER_SEM.release()
+        _unpin_media(media_paths.values())
+        await _remove_tree(temp_dir)
         raise
     except Exception as e:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        if holding_slot:
+            _RENDER_SEM.release()
+        _unpin_media(media_paths.values())
+        await _remove_tree(temp_dir)
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 